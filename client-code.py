@@ -1,16 +1,54 @@
 # client-code.py
 import socket
-import json
 import sys
 import os
-from typing import Dict, List
+import struct
+import time
+from typing import Dict, List, Optional
+
+import msgspec
+
+class Request(msgspec.Struct):
+    type: str
+
+class Record(msgspec.Struct, array_like=True):
+    id: str
+    firstname: str
+    lastname: str
+    email: str
+    City: str
+
+class DataResponse(msgspec.Struct):
+    type: str
+    data: List[Record]
+    client_id: Optional[str] = None
+    seq: int = 0
+    last: bool = True
+
+class IdLocationsResponse(msgspec.Struct):
+    type: str
+    data: Dict[str, str]
+    client_id: Optional[str] = None
+
+_ENC = msgspec.msgpack.Encoder()
+_HEADER = struct.Struct('>I')  # طول پیام به صورت big-endian
+_REQUEST_DEC = msgspec.msgpack.Decoder(Request)
+_DATA_DEC = msgspec.msgpack.Decoder(DataResponse)
+_ID_LOC_DEC = msgspec.msgpack.Decoder(IdLocationsResponse)
+
+SOCKET_BUFFER_SIZE = 1024 * 1024
+CONNECT_ATTEMPTS = 5
+RECV_BUFFER_SIZE = 65536
 
 class DataClient:
     def __init__(self, host: str = 'localhost', port: int = 5000):
         self.host = host
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.data: List[Dict] = []
+        self.socket: Optional[socket.socket] = None
+        self.recv_buf = bytearray(RECV_BUFFER_SIZE)
+        self.send_buf = bytearray()
+        self.updates_received = 0
+        self.data: List[Record] = []
         self.client_id = None
         self.load_client_id()
         
@@ -36,69 +74,106 @@ class DataClient:
         
     def connect(self):
         """اتصال به سرور"""
-        try:
-            self.socket.connect((self.host, self.port))
-            print("Connected to server")
-            return True
-        except Exception as e:
-            print(f"Connection failed: {e}")
-            return False
+        for attempt in range(CONNECT_ATTEMPTS):
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+                self.socket.connect((self.host, self.port))
+                print("Connected to server")
+                return True
+            except Exception as e:
+                self.socket.close()
+                self.socket = None
+                print(f"Connection failed: {e}")
+                if attempt < CONNECT_ATTEMPTS - 1:
+                    time.sleep(2 ** attempt * 0.1)
+        return False
+
+    def send_request(self, request: Request):
+        """ارسال درخواست به سرور"""
+        # sendall تا پایان ارسال برمی‌گردد، پس بافر برای درخواست بعدی قابل استفاده مجدد است
+        _ENC.encode_into(request, self.send_buf, _HEADER.size)
+        _HEADER.pack_into(self.send_buf, 0, len(self.send_buf) - _HEADER.size)
+        self.socket.sendall(self.send_buf)
+
+    def recv_exact(self, n: int) -> memoryview:
+        """دریافت دقیق n بایت از سرور در بافر دریافت"""
+        if n > len(self.recv_buf):
+            self.recv_buf = bytearray(n)
+        view = memoryview(self.recv_buf)[:n]
+        pos = 0
+        while pos < n:
+            received = self.socket.recv_into(view[pos:], n - pos)
+            if received == 0:
+                raise ConnectionError("Connection closed by server")
+            pos += received
+        return view
 
     def receive_all(self):
         """دریافت کامل داده از سرور"""
-        BUFF_SIZE = 4096
-        data = b''
+        header = self.recv_exact(_HEADER.size)
+        return self.recv_exact(_HEADER.unpack(header)[0])
+
+    def receive_response(self, decoder: msgspec.msgpack.Decoder):
+        """دریافت پاسخ و اعمال به‌روزرسانی‌های ارسال شده توسط سرور"""
         while True:
-            part = self.socket.recv(BUFF_SIZE)
-            data += part
-            if len(part) < BUFF_SIZE:
-                break
-        return data.decode()
+            buf = self.receive_all()
+            # فقط فیلد type خوانده می‌شود و بقیه فیلدها نادیده گرفته می‌شوند
+            if _REQUEST_DEC.decode(buf).type != 'data_update':
+                return decoder.decode(buf)
+            self.data = _DATA_DEC.decode(buf).data
+            self.updates_received += 1
             
     def request_data(self):
         """درخواست داده از سرور"""
         try:
-            request = {
-                'type': 'get_data'
-            }
-            self.socket.send(json.dumps(request).encode())
+            request = Request(type='get_data')
+            self.send_request(request)
             
-            response = json.loads(self.receive_all())
-            if response['type'] == 'data_response':
-                self.data = response['data']
-                if 'client_id' in response and response['client_id'] != self.client_id:
-                    self.save_client_id(response['client_id'])
+            response = self.receive_response(_DATA_DEC)
+            if response.type == 'data_response':
+                data = response.data
+                updates_seen = self.updates_received
+                while not response.last:
+                    response = self.receive_response(_DATA_DEC)
+                    data.extend(response.data)
+                # به‌روزرسانی رسیده در میانه پاسخ، کل رکوردهای فعلی کلاینت را دارد و جدیدتر است
+                if self.updates_received == updates_seen:
+                    self.data = data
+                if response.client_id is not None and response.client_id != self.client_id:
+                    self.save_client_id(response.client_id)
                 
-                print("\nReceived data:")
+                lines = ["\nReceived data:"]
                 if not self.data:
-                    print("No data available")
+                    lines.append("No data available")
                 else:
                     for record in self.data:
-                        print("\nRecord:")
-                        for key, value in record.items():
-                            print(f"{key}: {value}")
-                        print("-" * 50)
+                        lines.append("\nRecord:")
+                        lines.extend(f"{key}: {getattr(record, key)}" for key in record.__struct_fields__)
+                        lines.append("-" * 50)
+                sys.stdout.write("\n".join(lines) + "\n")
         except Exception as e:
             print(f"Error requesting data: {e}")
             
     def request_id_locations(self):
         """درخواست موقعیت رکوردها"""
         try:
-            request = {
-                'type': 'get_id_locations'
-            }
-            self.socket.send(json.dumps(request).encode())
+            request = Request(type='get_id_locations')
+            self.send_request(request)
             
-            response = json.loads(self.receive_all())
-            if response['type'] == 'id_locations_response':
-                if 'client_id' in response and response['client_id'] != self.client_id:
-                    self.save_client_id(response['client_id'])
+            response = self.receive_response(_ID_LOC_DEC)
+            if response.type == 'id_locations_response':
+                if response.client_id is not None and response.client_id != self.client_id:
+                    self.save_client_id(response.client_id)
                     
                 print("\nRecord Locations:")
-                if not response['data']:
+                if not response.data:
                     print("No records currently allocated")
                 else:
-                    for record_id, client in response['data'].items():
+                    for record_id, client in response.data.items():
                         print(f"Record {record_id} is assigned to {client}")
         except Exception as e:
             print(f"Error requesting record locations: {e}")
@@ -106,7 +181,9 @@ class DataClient:
     def disconnect(self):
         """قطع اتصال از سرور"""
         try:
-            self.socket.close()
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
             print("Disconnected from server")
         except Exception as e:
             print(f"Error disconnecting: {e}")
@@ -1,25 +1,75 @@
 # server-code.py
+import asyncio
 import socket
-import threading
-import json
 import random
 import csv
 import logging
+import queue
 import uuid
 import os
+import struct
 from datetime import datetime
-from typing import Dict, List, Set
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+import msgspec
+
+class Request(msgspec.Struct):
+    type: str
+
+class Record(msgspec.Struct, array_like=True):
+    id: str
+    firstname: str
+    lastname: str
+    email: str
+    City: str
+
+class DataResponse(msgspec.Struct):
+    type: str
+    data: List[msgspec.Raw]  # رکوردهای Record که از قبل رمزگذاری شده‌اند
+    client_id: Optional[str] = None
+    seq: int = 0
+    last: bool = True
+
+class IdLocationsResponse(msgspec.Struct):
+    type: str
+    data: msgspec.Raw  # نقشه record_id -> client_id که از قبل رمزگذاری شده
+    client_id: Optional[str] = None
+
+_ENC = msgspec.msgpack.Encoder()
+_HEADER = struct.Struct('>I')  # طول پیام به صورت big-endian
+_REQUEST_DEC = msgspec.msgpack.Decoder(Request)
+
+# مقادیر بزرگ‌تر از net.core.rmem_max/wmem_max توسط کرنل محدود می‌شوند؛
+# برای استفاده کامل باید sysctl -w net.core.rmem_max=12582912 net.core.wmem_max=12582912 تنظیم شود
+SOCKET_BUFFER_SIZE = 4_000_000
+NOTSENT_LOWAT = 128 * 1024
+CHUNK_SIZE = 256
+CLIENT_IDS_FLUSH_INTERVAL = 5  # seconds
+
+def strip_quotes(fields: Iterable[str]) -> List[str]:
+    """حذف '...' بیرونی از هر فیلد CSV"""
+    return [f[1:-1] if len(f) >= 2 and f[0] == f[-1] == "'" else f for f in fields]
 
 class DataDistributionServer:
     def __init__(self, host: str = 'localhost', port: int = 5000):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients: Dict[str, socket.socket] = {}  # client_id -> socket
-        self.client_data: Dict[str, List[Dict]] = {}  # client_id -> data records
-        self.available_data: List[Dict] = []
-        self.lock = threading.Lock()
+        self.clients: Dict[str, asyncio.StreamWriter] = {}  # client_id -> writer
+        self.client_data: Dict[str, List[int]] = {}  # client_id -> record indices
+        self.records: List[Record] = []
+        self.encoded_records: List[msgspec.Raw] = []
+        self.available_indices: List[int] = []
+        self.id_locations: Dict[str, str] = {}  # record_id -> client_id
+        self._id_loc_raw: Optional[msgspec.Raw] = None  # encoded id_locations, None when stale
         self.client_ids: Dict[str, str] = {}  # addr -> client_uuid
+        self._ids_dirty = False
+        self._background_tasks: Set[asyncio.Task] = set()  # نگه‌داشتن ارجاع تا پایان تسک
+        self._handlers = {  # request type -> handler(client_id, request) -> response frames
+            'get_data': self.handle_get_data,
+            'get_id_locations': self.handle_get_id_locations,
+        }
         
         # تنظیم سیستم لاگینگ
         self.setup_logging()
@@ -29,173 +79,271 @@ class DataDistributionServer:
         if not os.path.exists('logs'):
             os.makedirs('logs')
             
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(f'logs/server_{datetime.now().strftime("%Y%m%d")}.log'),
-                logging.StreamHandler()
-            ]
-        )
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        file_handler = logging.FileHandler(f'logs/server_{datetime.now().strftime("%Y%m%d")}.log')
+        file_handler.setFormatter(formatter)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        
+        # نوشتن لاگ‌ها در یک نخ جداگانه انجام می‌شود و حلقه رویداد فقط رکورد را در صف قرار می‌دهد
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.log_listener = QueueListener(log_queue, file_handler, stream_handler)
+        self.log_listener.start()
+        
+        logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
         self.logger = logging.getLogger(__name__)
 
     def load_client_ids(self):
         """بارگذاری شناسه‌های ذخیره شده کلاینت‌ها"""
         try:
             if os.path.exists('client_ids.json'):
-                with open('client_ids.json', 'r') as f:
-                    self.client_ids = json.load(f)
+                with open('client_ids.json', 'rb') as f:
+                    self.client_ids = msgspec.json.decode(f.read(), type=Dict[str, str])
                 self.logger.info(f"Loaded {len(self.client_ids)} stored client IDs")
         except Exception as e:
             self.logger.error(f"Error loading client IDs: {e}")
 
-    def save_client_ids(self):
-        """ذخیره شناسه‌های کلاینت‌ها"""
+    def save_client_ids(self) -> bool:
+        """ذخیره شناسه‌های کلاینت‌ها؛ در صورت موفقیت True برمی‌گرداند"""
         try:
-            with open('client_ids.json', 'w') as f:
-                json.dump(self.client_ids, f)
+            # نوشتن در فایل موقت و جایگزینی اتمی تا فایل نیمه‌کاره باقی نماند
+            with open('client_ids.json.tmp', 'wb') as f:
+                f.write(msgspec.json.encode(self.client_ids))
+            os.replace('client_ids.json.tmp', 'client_ids.json')
             self.logger.info("Saved client IDs to file")
+            return True
         except Exception as e:
             self.logger.error(f"Error saving client IDs: {e}")
+            return False
 
     def get_client_id(self, addr: str) -> str:
         """دریافت یا ایجاد شناسه یکتا برای کلاینت"""
-        if addr not in self.client_ids:
-            self.client_ids[addr] = str(uuid.uuid4())
-            self.save_client_ids()
-            self.logger.info(f"Generated new client ID for {addr}: {self.client_ids[addr]}")
-        return self.client_ids[addr]
+        client_id = self.client_ids.get(addr)
+        if client_id is not None:
+            return client_id
+            
+        client_id = uuid.uuid4().hex
+        self.client_ids[addr] = client_id
+        self._ids_dirty = True
+        self.logger.info(f"Generated new client ID for {addr}: {client_id}")
+        return client_id
 
     def load_data(self, filename: str):
         """بارگذاری داده از فایل CSV"""
         try:
             with open(filename, 'r', encoding='utf-8') as file:
-                csv_reader = csv.DictReader(file)
-                self.available_data = list(csv_reader)
-                self.logger.info(f"Loaded {len(self.available_data)} records from {filename}")
-                if self.available_data:
-                    self.logger.info(f"Available columns: {list(self.available_data[0].keys())}")
+                # فیلدها با گویش پیش‌فرض خوانده می‌شوند و فقط '...' بیرونی هر فیلد حذف می‌شود؛
+                # quotechar="'" داده‌هایی مثل O"Conner' را به هم می‌ریخت
+                csv_reader = csv.reader(file)
+                columns = tuple(strip_quotes(next(csv_reader, ())))
+                if columns != Record.__struct_fields__:
+                    raise ValueError(f"Unexpected columns {list(columns)}, expected {list(Record.__struct_fields__)}")
+                self.records = [Record(*strip_quotes(row)) for row in csv_reader]
+                self.encoded_records = [msgspec.Raw(_ENC.encode(record)) for record in self.records]
+                self.available_indices = list(range(len(self.records)))
+                random.shuffle(self.available_indices)
+                self.logger.info(f"Loaded {len(self.records)} records from {filename}")
+                if self.records:
+                    self.logger.info(f"Available columns: {list(columns)}")
         except Exception as e:
             self.logger.error(f"Error loading data: {e}")
-            self.available_data = []
+            self.records = []
+            self.encoded_records = []
+            self.available_indices = []
+
+    def encode_frame(self, data: msgspec.Struct) -> bytearray:
+        """رمزگذاری پیام با پیشوند طول"""
+        frame = bytearray(_HEADER.size)
+        _ENC.encode_into(data, frame, _HEADER.size)
+        _HEADER.pack_into(frame, 0, len(frame) - _HEADER.size)
+        return frame
 
-    def send_data(self, client_socket: socket.socket, data: dict):
+    async def send_data(self, writer: asyncio.StreamWriter, messages: Iterable[msgspec.Struct]):
         """ارسال داده به صورت امن"""
         try:
-            json_data = json.dumps(data)
-            message = json_data.encode()
-            total_sent = 0
-            while total_sent < len(message):
-                sent = client_socket.send(message[total_sent:])
-                if sent == 0:
-                    raise RuntimeError("socket connection broken")
-                total_sent += sent
+            # هر فریم به محض رمزگذاری نوشته می‌شود و قبل از ساخت فریم بعدی منتظر تخلیه بافر می‌مانیم
+            for message in messages:
+                writer.write(self.encode_frame(message))
+                await writer.drain()
         except Exception as e:
             self.logger.error(f"Error sending data: {e}")
             
-    def distribute_data(self, client_id: str) -> List[Dict]:
+    def configure_socket(self, client_socket: socket.socket):
+        """تنظیم گزینه‌های سوکت کلاینت"""
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, NOTSENT_LOWAT)
+
+    def distribute_data(self, client_id: str) -> List[int]:
         """توزیع داده‌های موجود به کلاینت"""
-        with self.lock:
-            if not self.available_data:
-                return []
-                
-            n_records = max(1, len(self.available_data) // (len(self.clients) + 1))
-            selected_indices = random.sample(range(len(self.available_data)), min(n_records, len(self.available_data)))
-            selected_data = [self.available_data[i] for i in sorted(selected_indices, reverse=True)]
+        if not self.available_indices:
+            return []
             
-            for i in sorted(selected_indices, reverse=True):
-                self.available_data.pop(i)
-                
-            self.client_data[client_id] = selected_data
-            self.logger.info(f"Distributed {len(selected_data)} records to client {client_id}")
-            return selected_data
+        # ترتیب available_indices تصادفی است، پس انتهای لیست یک نمونه تصادفی است
+        n_records = max(1, len(self.available_indices) // (len(self.clients) + 1))
+        selected_indices = self.available_indices[-n_records:]
+        del self.available_indices[-n_records:]
+        return self.assign_data(client_id, selected_indices)
+
+    def assign_data(self, client_id: str, selected_indices: List[int]) -> List[int]:
+        """ثبت رکوردهای انتخاب شده برای کلاینت"""
+        for i in self.client_data.get(client_id, ()):
+            del self.id_locations[self.records[i].id]
+        for i in selected_indices:
+            self.id_locations[self.records[i].id] = client_id
+        self._id_loc_raw = None
+        self.client_data[client_id] = selected_indices
+        self.logger.info(f"Distributed {len(selected_indices)} records to client {client_id}")
+        return selected_indices
             
     def redistribute_data(self, disconnected_client_id: str):
         """توزیع مجدد داده‌های کلاینت قطع شده"""
-        with self.lock:
-            if disconnected_client_id not in self.client_data:
-                return
-                
-            self.logger.info(f"Redistributing data from {disconnected_client_id}")
-            self.available_data.extend(self.client_data[disconnected_client_id])
-            del self.client_data[disconnected_client_id]
+        if disconnected_client_id not in self.client_data:
+            return
             
-            if self.clients:
-                for client_id in self.clients:
-                    new_data = self.distribute_data(client_id)
-                    if new_data:
-                        response = {
-                            'type': 'data_update',
-                            'data': new_data
-                        }
-                        self.send_data(self.clients[client_id], response)
+        self.logger.info(f"Redistributing data from {disconnected_client_id}")
+        orphaned = self.client_data.pop(disconnected_client_id)
+        self._id_loc_raw = None
+        if not self.clients:
+            for i in orphaned:
+                del self.id_locations[self.records[i].id]
+            self.available_indices.extend(orphaned)
+            random.shuffle(self.available_indices)
+            return
+            
+        # رکوردهای کلاینت قطع شده در یک گذر بین کلاینت‌های باقی‌مانده تقسیم می‌شوند
+        # و فریم‌های به‌روزرسانی بدون هیچ await نوشته می‌شوند تا به‌روزرسانی قدیمی‌تر بعد از جدیدتر نرسد
+        n_clients = len(self.clients)
+        writers = []
+        for offset, (client_id, writer) in enumerate(self.clients.items()):
+            share = orphaned[offset::n_clients]
+            if not share:
+                continue
+            for i in share:
+                self.id_locations[self.records[i].id] = client_id
+            # لیست جدید ساخته می‌شود چون ممکن است پاسخ در حال ارسال همان لیست قبلی را پیمایش کند
+            client_indices = self.client_data.get(client_id, []) + share
+            self.client_data[client_id] = client_indices
+            self.logger.info(f"Redistributed {len(share)} records to client {client_id}")
+            response = DataResponse(type='data_update', data=[self.encoded_records[i] for i in client_indices])
+            writer.write(self.encode_frame(response))
+            writers.append(writer)
+        # تخلیه بافرها هم‌زمان و در پس‌زمینه انجام می‌شود تا یک کلاینت کند بقیه را معطل نکند
+        task = asyncio.create_task(self.drain_all(writers))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def drain_all(self, writers: List[asyncio.StreamWriter]):
+        """تخلیه هم‌زمان بافر چند کلاینت"""
+        results = await asyncio.gather(*(writer.drain() for writer in writers), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error(f"Error sending data: {result}")
                         
-    def handle_client(self, client_socket: socket.socket, addr: str):
+    def iter_data_chunks(self, client_id: str, indices: List[int]) -> Iterator[DataResponse]:
+        """ساخت تدریجی فریم‌های پاسخ داده"""
+        for seq, start in enumerate(range(0, max(len(indices), 1), CHUNK_SIZE)):
+            chunk = [self.encoded_records[i] for i in indices[start:start + CHUNK_SIZE]]
+            yield DataResponse(type='data_response', data=chunk, client_id=client_id,
+                               seq=seq, last=start + CHUNK_SIZE >= len(indices))
+
+    def handle_get_data(self, client_id: str, request: Request) -> Iterator[DataResponse]:
+        """ساخت پاسخ درخواست دریافت داده"""
+        # توزیع همین‌جا انجام می‌شود و فقط ساخت فریم‌ها به تدریج و هنگام ارسال است
+        return self.iter_data_chunks(client_id, self.distribute_data(client_id))
+
+    def handle_get_id_locations(self, client_id: str, request: Request) -> List[IdLocationsResponse]:
+        """ساخت پاسخ درخواست موقعیت رکوردها"""
+        if self._id_loc_raw is None:
+            self._id_loc_raw = msgspec.Raw(_ENC.encode(self.id_locations))
+        return [IdLocationsResponse(type='id_locations_response', data=self._id_loc_raw, client_id=client_id)]
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """مدیریت اتصال کلاینت"""
+        addr = writer.get_extra_info('peername')
+        self.configure_socket(writer.get_extra_info('socket'))
         client_id = self.get_client_id(str(addr))
+        self.clients[client_id] = writer
         self.logger.info(f"Client connected - Address: {addr}, ID: {client_id}")
         
+        # متغیرهای محلی برای حلقه پردازش درخواست‌ها
+        readexactly = reader.readexactly
+        header_size = _HEADER.size
+        unpack_header = _HEADER.unpack
+        decode_request = _REQUEST_DEC.decode
+        get_handler = self._handlers.get
+        send_data = self.send_data
+        log_debug = self.logger.debug
+        debug_enabled = self.logger.isEnabledFor(logging.DEBUG)
+        
         try:
             while True:
-                data = client_socket.recv(4096).decode()
-                if not data:
+                try:
+                    header = await readexactly(header_size)
+                    data = await readexactly(unpack_header(header)[0])
+                except asyncio.IncompleteReadError:
                     break
                     
-                request = json.loads(data)
-                self.logger.debug(f"Received request from {client_id}: {request['type']}")
+                request = decode_request(data)
+                if debug_enabled:
+                    log_debug(f"Received request from {client_id}: {request.type}")
                 
-                if request['type'] == 'get_data':
-                    client_data = self.distribute_data(client_id)
-                    response = {
-                        'type': 'data_response',
-                        'data': client_data,
-                        'client_id': client_id
-                    }
-                    self.send_data(client_socket, response)
-                    
-                elif request['type'] == 'get_id_locations':
-                    id_locations = {}
-                    for cid, data_list in self.client_data.items():
-                        for record in data_list:
-                            first_key = next(iter(record))
-                            id_locations[record[first_key]] = cid
-                    response = {
-                        'type': 'id_locations_response',
-                        'data': id_locations,
-                        'client_id': client_id
-                    }
-                    self.send_data(client_socket, response)
+                handler = get_handler(request.type)
+                if handler is not None:
+                    await send_data(writer, handler(client_id, request))
                     
         except Exception as e:
             self.logger.error(f"Error handling client {client_id}: {e}")
         finally:
             self.logger.info(f"Client disconnected: {client_id}")
-            with self.lock:
-                if client_id in self.clients:
-                    del self.clients[client_id]
-                    self.redistribute_data(client_id)
+            writer.close()
+            if client_id in self.clients:
+                del self.clients[client_id]
+                self.redistribute_data(client_id)
                     
+    async def flush_client_ids(self):
+        """ذخیره دوره‌ای شناسه‌های کلاینت‌ها در صورت تغییر"""
+        while True:
+            await asyncio.sleep(CLIENT_IDS_FLUSH_INTERVAL)
+            if self._ids_dirty:
+                # پرچم قبل از ذخیره پاک می‌شود تا شناسه‌های جدید حین ذخیره از دست نروند
+                # و در صورت خطا دوباره تنظیم می‌شود تا در دور بعد تلاش مجدد شود
+                self._ids_dirty = False
+                if not await asyncio.to_thread(self.save_client_ids):
+                    self._ids_dirty = True
+
+    async def serve(self):
+        """اجرای حلقه رویداد سرور"""
+        server = await asyncio.start_server(self.handle_client, sock=self.server_socket, backlog=5)
+        flusher = asyncio.create_task(self.flush_client_ids())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flusher.cancel()
+
     def start(self):
         """راه‌اندازی سرور"""
         self.load_client_ids()
+        # بافر دریافت قبل از listen تنظیم می‌شود تا سوکت‌های پذیرفته شده آن را به ارث ببرند
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
         self.logger.info(f"Server listening on {self.host}:{self.port}")
         
         try:
-            while True:
-                client_socket, addr = self.server_socket.accept()
-                client_id = self.get_client_id(str(addr))
-                self.clients[client_id] = client_socket
-                
-                thread = threading.Thread(target=self.handle_client, 
-                                       args=(client_socket, addr))
-                thread.daemon = True
-                thread.start()
+            asyncio.run(self.serve())
         except KeyboardInterrupt:
             self.logger.info("Server shutting down...")
         finally:
             self.server_socket.close()
+            if self._ids_dirty:
+                self.save_client_ids()
+            self.log_listener.stop()
 
 if __name__ == "__main__":
     server = DataDistributionServer()